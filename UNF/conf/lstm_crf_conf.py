@@ -27,7 +27,8 @@ data_loader_conf = {
             "attrs":{
                 "tokenize":"WhitespaceTokenizer",
                 "sequential": True,
-                "unk_token": None
+                "unk_token": None,
+                "batch_first": True
             }
         }],
     "iterator":{
@@ -20,12 +20,16 @@ class DataLoader(object):
     一个Batch对象，生成Batch对象的时候会调用Field对象的process方法完成string2id的映射转换和pad过程；
     Batch对象主要是包含一个batch_size的Example对象
 
+    iterator配置中可以用max_tokens代替batch_size，按padding之后的token数组batch，
+    batch内按text_field的长度排序，减少padding
+
     """
 
-    def __init__(self, config):
+    def __init__(self, config, text_field="TEXT"):
         self.config = config
         self.SEED = 1441 #magic data
         self.fields = None
+        self.text_field = text_field
 
     def generate_dataset(self):
         fields = self.config["fields"]
@@ -75,6 +79,29 @@ class DataLoader(object):
                     obj.build_vocab(datasets[0])
 
         #step4: Iterator对象生成
-        data_iterator = BucketIterator.splits((train_datasets, valid_datasets, test_datasets), sort=False, **self.config["iterator"])
+        #按长度分桶，batch内排序，减少padding的token
+        iterator_conf = dict(self.config["iterator"])
+        iterator_conf.setdefault("sort_key", lambda x: len(getattr(x, self.text_field)))
+        iterator_conf.setdefault("sort_within_batch", True)
+        if "max_tokens" in iterator_conf:
+            iterator_conf["batch_size"] = iterator_conf.pop("max_tokens")
+            iterator_conf["batch_size_fn"] = token_batch_size_fn(self.text_field)
+
+        data_iterator = BucketIterator.splits((train_datasets, valid_datasets, test_datasets), sort=False, **iterator_conf)
 
         return data_iterator
+
+
+def token_batch_size_fn(field_name):
+    """
+    BucketIterator的batch_size_fn，batch大小按padding之后的token数计算
+    """
+    max_len = [0]
+
+    def batch_size_fn(new, count, sofar):
+        if count == 1:
+            max_len[0] = 0
+        max_len[0] = max(max_len[0], len(getattr(new, field_name)))
+        return count * max_len[0]
+
+    return batch_size_fn
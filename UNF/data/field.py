@@ -1,6 +1,6 @@
 #coding:utf-8
 """
-对处理数据域的抽象
+对处理数据域的抽象，默认batch_first，iterator直接产出连续的[batch, length]的tensor
 """
 from torchtext.data.field import RawField, Field, LabelField
 
@@ -11,6 +11,7 @@ class WordField(Field):
     """
     def __init__(self, **kwarg):
         print(kwarg)
+        kwarg.setdefault("batch_first", True)
         super(WordField, self).__init__(**kwarg)
 
 class CharField(Field):
@@ -18,6 +19,7 @@ class CharField(Field):
     数据字符域的抽象
     """
     def __init__(self, **kwarg):
+        kwarg.setdefault("batch_first", True)
         super(CharField, self).__init__(**kwarg)
 
 class SiteField(Field):
@@ -25,4 +27,5 @@ class SiteField(Field):
     站点域的抽象
     """
     def __init__(self,  **kwarg):
+        kwarg.setdefault("batch_first", True)
         super(SiteField, self).__init__(**kwarg)
@@ -13,7 +13,8 @@ class ModelTrace(nn.Module):
         """
         super(ModelTrace, self).__init__()
         if input_dim is not None and vocab_size is not None:
-            self.embedding = TokenEmbedding(input_dim, vocab_size)
+            self.embedding = TokenEmbedding(input_dim, vocab_size,
+                                            sparse=kwargs.get("sparse_embedding", False))
             #加载预训练的词向量
             if "pretrain" in kwargs:
                 if kwargs["pretrain"]:
@@ -2,6 +2,8 @@
 from __future__ import absolute_import
 import os
 import sys
+from typing import Optional
+
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -32,10 +34,12 @@ class TextCnnTrace(ModelTrace):
         self.encoder = CnnMaxpoolLayer(input_dim,
                     filter_num, filter_size, **kwargs)
         
-        self.dropout = nn.Dropout(p=dropout)
+        #encoder最后的激活输出会被autograd保存，dropout不能inplace；p为0时直接跳过dropout
+        self.dropout = nn.Dropout(p=dropout) if dropout > 0 else nn.Identity()
         self.fc = nn.Linear(sum(filter_num), label_nums)
 
-    def forward(self, input, mask=None, label=None):
+    def forward(self, input, mask: Optional[torch.Tensor] = None,
+                label: Optional[torch.Tensor] = None):
         if len(input.size()) == 1:
             input = input.unsqueeze(0)
 
@@ -58,7 +62,8 @@ class TextCnn(Model):
         self.model = TextCnnTrace(input_dim, vocab_size, filter_size, filter_num, 
                             label_nums, dropout, **kwargs)
 
-    def forward(self, input, mask=None, label=None):
+    def forward(self, input, mask: Optional[torch.Tensor] = None,
+                label: Optional[torch.Tensor] = None):
         logits = self.model(input, mask, label)
         return {"logits": logits}
 
@@ -48,7 +48,8 @@ class TokenEmbedding(BaseEmbedding):
                     init_type=InitType.XAVIER_NORMAL,
                     low=0, high=1, mean=0, std=1,
                     activation_type=ActivationType.NONE,
-                    fan_mode=FAN_MODE.FAN_IN, negative_slope=0
+                    fan_mode=FAN_MODE.FAN_IN, negative_slope=0,
+                    sparse=False
                     ):
         """
         Embedding类的基础类
@@ -58,11 +59,12 @@ class TokenEmbedding(BaseEmbedding):
         :params device string or [string1, string2],计算的后端，默认是cpu
         :params init_type string, 初始化的计算方式 ，默认采用uniform初始化
         :params dropout float
+        :params sparse bool 是否产生稀疏梯度，只更新batch中出现的词，需要配合SparseAdam
         """
         super(TokenEmbedding, self).__init__(dim, vocab_size, device,
                                                 dropout)
 
-        self.embeddings = nn.Embedding(vocab_size, dim)
+        self.embeddings = nn.Embedding(vocab_size, dim, sparse=sparse)
         embedding_lookup_table = init_tensor(tensor=torch.empty(vocab_size, dim),
                 init_type=init_type, low=low, high=high, mean=mean, std=std,
                 activation_type=activation_type, fan_mode=fan_mode, 
@@ -1,6 +1,8 @@
 #coding:utf-8
 import os
 import sys
+from typing import Optional
+
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -14,6 +16,8 @@ class CnnMaxpoolLayer(nn.Module):
                 activation='relu', initial_method=None, **kwargs):
         """
         cnn+maxpooling的结构做encoder
+        所有卷积核右侧补零到最大的卷积核大小后拼成一个卷积，一次卷积算完所有的filter
+
         :params input_num int 输入的维度
         :params output_num int|list 每个卷积核输出的维度
         :params filter_size list 卷积核的大小
@@ -29,54 +33,89 @@ class CnnMaxpoolLayer(nn.Module):
         assert len(filter_size) == len(output_num), \
                 "Filter size len is not equal output_num len"
 
-        print("stride", stride)
-        self.convs = nn.ModuleList(
-            [nn.Conv1d(in_channels=input_num, out_channels=on, 
-                        kernel_size=ks, stride=stride, padding=padding, bias=False) 
-                        for on, ks in zip(output_num, filter_size)]
-        )
-
+        self.stride = stride
+        self.padding = padding
+        self.max_filter_size = max(filter_size)
+        self.min_filter_size = min(filter_size)
+        self.same_filter_size = self.max_filter_size == self.min_filter_size
+
+        #每个卷积核先按Conv1d的默认方式初始化，再补零拼接，保持和原来分开卷积时一样的初始化分布
+        weights, weight_masks = [], []
+        for on, ks in zip(output_num, filter_size):
+            conv = nn.Conv1d(in_channels=input_num, out_channels=on, kernel_size=ks, bias=False)
+            weights.append(F.pad(conv.weight.data, (0, self.max_filter_size - ks)))
+            weight_masks.append(F.pad(torch.ones_like(conv.weight.data), (0, self.max_filter_size - ks)))
+        self.weight = nn.Parameter(torch.cat(weights, dim=0)) #[sum(o), d, max_filter_size]
+        #补零的位置不参与训练
+        self.register_buffer("weight_mask", torch.cat(weight_masks, dim=0), persistent=False)
+        #每个输出通道对应的卷积核大小，用来计算各自的有效输出长度
+        self.register_buffer("channel_filter_size",
+                    torch.tensor([ks for on, ks in zip(output_num, filter_size) for _ in range(on)]),
+                    persistent=False)
+
+        #激活函数用module而不是函数对象，torch.jit.script才能编译
         if activation == "relu":
-            self.activation = F.relu
+            self.activation = nn.ReLU()
         elif activation == "sigmoid":
-            self.activation = F.sigmoid
+            self.activation = nn.Sigmoid()
         elif activation == "tanh":
-            self.activation = F.tanh
+            self.activation = nn.Tanh()
         else:
             raise Exception("%s activation not support" % activation)
 
         #使用默认初始化
         #initial_parameter(self, initial_method)
 
-    def forward(self, input, mask=None):
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        #script之后的模型state_dict里会带上非持久化的buffer，这里直接丢掉，以__init__里算出来的为准
+        state_dict.pop(prefix + "weight_mask", None)
+        state_dict.pop(prefix + "channel_filter_size", None)
+
+        #兼容每个卷积核单独一个Conv1d(convs.{i}.weight)时保存的模型
+        conv_keys = sorted([k for k in state_dict if k.startswith(prefix + "convs.")],
+                           key=lambda k: int(k[len(prefix + "convs."):].split(".")[0]))
+        if conv_keys and prefix + "weight" not in state_dict:
+            state_dict[prefix + "weight"] = torch.cat(
+                [self._pad_weight(state_dict.pop(k)) for k in conv_keys], dim=0)
+
+        super(CnnMaxpoolLayer, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs)
+
+    def _pad_weight(self, weight):
+        return F.pad(weight, (0, self.max_filter_size - weight.size(2)))
+
+    def forward(self, input, mask: Optional[torch.Tensor] = None):
         """
         :params: input torch.Tensor [batch_size, length, dim]
         :params: mask torch.Tensor [batch_size, length]
+
+        length比最大的卷积核还短时，输入右侧补零到最大卷积核的长度再卷积，不报错
         """
         if mask is not None:
-            input = input * mask.unsqueeze(-1).float()
+            input = input * mask.unsqueeze(-1).to(input.dtype)
 
         #[b, l, d] -> [b, d, l]
         input = torch.transpose(input, 1, 2)
-        conv_res = [self.activation(conv(input)) for conv in self.convs] #[b, o, lout]
-
-        #import pdb;pdb.set_trace()
-        tmp = []
-        for i in range(len(conv_res)):
-            dim = conv_res[i].size(2)
-            if isinstance(dim, torch.Tensor):
-                #trace 无法识别tuple的操作，会转成tensor
-                dim = dim.tolist()
-            max_out = F.max_pool1d(conv_res[i], kernel_size=dim)
-            tmp.append(max_out.squeeze(2))
-
-        return torch.cat(tmp, dim=-1)
-
-
-
-
-
-
-
-
-
+        length = input.size(2)
+        #按长度分桶后整个batch都比最大的卷积核短很常见，右侧补零到最大卷积核的长度，
+        #不补的话大卷积核没有合法的窗口，输出会变成激活函数作用在-inf上的值
+        if length + 2 * self.padding < self.max_filter_size:
+            input = F.pad(input, (0, self.max_filter_size - 2 * self.padding - length))
+            length = self.max_filter_size - 2 * self.padding
+
+        #右侧多补max_filter_size - min_filter_size个位置，保证小卷积核的输出长度和单独卷积时一致
+        input = F.pad(input, (self.padding, self.padding + self.max_filter_size - self.min_filter_size))
+        conv_res = F.conv1d(input, self.weight * self.weight_mask, stride=self.stride) #[b, sum(o), lout]
+
+        if not self.same_filter_size:
+            #大卷积核在末尾的输出覆盖了补的零，不是合法的窗口，不参与max
+            valid_length = torch.div(length + 2 * self.padding - self.channel_filter_size,
+                                     self.stride, rounding_mode="floor") + 1
+            positions = torch.arange(conv_res.size(2), device=conv_res.device)
+            invalid = positions.unsqueeze(0) >= valid_length.unsqueeze(1) #[sum(o), lout]
+            conv_res = conv_res.masked_fill(invalid.unsqueeze(0), float("-inf"))
+
+        #max over time，激活函数都是单调的，先取max再激活只需要对[b, sum(o)]做激活
+        return self.activation(conv_res.max(dim=2)[0])
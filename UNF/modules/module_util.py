@@ -107,6 +107,6 @@ def mask_softmax(input, dim, mask=None):
         return F.softmax(input, dim=dim)
 
     else:
-        masked_input = input.masked_fill((1 - mask.unsqueeze(-1)).byte(), -1e32)
+        masked_input = input.masked_fill(~mask.unsqueeze(-1).bool(), -1e32)
         return F.softmax(masked_input, dim=dim)
 
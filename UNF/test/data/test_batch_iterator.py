@@ -0,0 +1,73 @@
+#coding:utf-8
+import random
+from unittest import TestCase
+
+from torchtext.data import Field, Dataset, Example, BucketIterator
+
+from data.data_loader import token_batch_size_fn
+from training.learner_util import DistributedIterator, mark_last
+
+
+def build_dataset(num_examples=64, max_length=20, seed=1441):
+    rand = random.Random(seed)
+    fields = [("id", Field(sequential=False, use_vocab=False)),
+              ("text", Field(batch_first=True))]
+    examples = [
+        Example.fromlist([i, " ".join(["w%d" % rand.randint(0, 9)
+                                       for _ in range(rand.randint(1, max_length))])], fields)
+        for i in range(num_examples)
+    ]
+    dataset = Dataset(examples, fields)
+    dataset.fields["text"].build_vocab(dataset)
+    return dataset
+
+
+def build_iterator(dataset, max_tokens):
+    return BucketIterator(dataset, batch_size=max_tokens,
+                          batch_size_fn=token_batch_size_fn("text"),
+                          sort_key=lambda x: len(x.text), sort_within_batch=True,
+                          shuffle=True, repeat=False, device="cpu")
+
+
+class TestBatchIterator(TestCase):
+
+    def test_max_tokens(self):
+        dataset = build_dataset()
+        for max_tokens in [20, 37, 100]:
+            seen = []
+            for batch in build_iterator(dataset, max_tokens):
+                #padding之后的token数不超过max_tokens
+                self.assertLessEqual(batch.text.numel(), max_tokens)
+                seen.extend(batch.id.tolist())
+            self.assertEqual(sorted(seen), list(range(len(dataset))))
+
+    def test_distributed_iterator(self):
+        dataset = build_dataset()
+        world_size = 2
+        ranks = []
+        for rank in range(world_size):
+            #模拟不同的进程，torchtext的shuffler默认取的全局随机状态各不相同
+            random.seed(rank)
+            ranks.append(DistributedIterator(build_iterator(dataset, 40), rank, world_size))
+
+        epoch_batches = []
+        for epoch in range(2):
+            batches = []
+            for data_iter in ranks:
+                data_iter.set_epoch(epoch)
+                batches.append([tuple(batch.id.tolist()) for batch in data_iter])
+
+            #各个进程的batch数相同，样本不重叠
+            self.assertEqual(len(batches[0]), len(batches[1]))
+            self.assertGreater(len(batches[0]), 0)
+            ids = [i for rank_batches in batches for batch in rank_batches for i in batch]
+            self.assertEqual(len(ids), len(set(ids)))
+            epoch_batches.append(batches)
+
+        #不同epoch的shuffle顺序不同
+        self.assertNotEqual(epoch_batches[0][0], epoch_batches[1][0])
+
+    def test_mark_last(self):
+        self.assertEqual(list(mark_last([1, 2, 3])), [(1, False), (2, False), (3, True)])
+        self.assertEqual(list(mark_last(iter([1]))), [(1, True)])
+        self.assertEqual(list(mark_last([])), [])
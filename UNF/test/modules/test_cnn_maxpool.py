@@ -0,0 +1,85 @@
+#coding:utf-8
+from unittest import TestCase
+
+import torch
+import torch.nn.functional as F
+
+from modules.encoder.cnn_maxpool import CnnMaxpoolLayer
+
+
+def reference_forward(layer, input, output_num, filter_size, stride, padding, activation):
+    """
+    每个卷积核单独一个Conv1d再做max pooling的原始实现，权重从拼接后的weight里切出来
+    """
+    input = torch.transpose(input, 1, 2)
+    res, offset = [], 0
+    for on, ks in zip(output_num, filter_size):
+        weight = layer.weight[offset:offset + on, :, :ks]
+        offset += on
+        conv_res = activation(F.conv1d(input, weight, stride=stride, padding=padding))
+        res.append(F.max_pool1d(conv_res, kernel_size=conv_res.size(2)).squeeze(2))
+    return torch.cat(res, dim=-1)
+
+
+class TestCnnMaxpool(TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1441)
+
+    def test_equal_to_per_filter_conv(self):
+        cases = [
+            ([1, 2, 3], [4, 4, 4], 1, 0, "relu", torch.relu),
+            ([2, 5, 3], [3, 6, 2], 1, 1, "tanh", torch.tanh),
+            ([1, 4], [5, 5], 2, 0, "sigmoid", torch.sigmoid),
+            ([3, 3], [4, 4], 3, 2, "relu", torch.relu),
+        ]
+        for filter_size, output_num, stride, padding, name, activation in cases:
+            layer = CnnMaxpoolLayer(8, output_num, filter_size, stride=stride,
+                                    padding=padding, activation=name)
+            for length in [5, 6, 11]:
+                input = torch.randn(3, length, 8)
+                expected = reference_forward(layer, input, output_num, filter_size,
+                                             stride, padding, activation)
+                self.assertTrue(torch.allclose(layer(input), expected, atol=1e-6),
+                                "filter_size %s stride %d padding %d length %d"
+                                % (filter_size, stride, padding, length))
+
+    def test_load_legacy_state_dict(self):
+        filter_size, output_num = [1, 2, 3], [4, 5, 6]
+        legacy_state = {
+            "convs.%d.weight" % i: torch.randn(on, 8, ks)
+            for i, (on, ks) in enumerate(zip(output_num, filter_size))
+        }
+
+        layer = CnnMaxpoolLayer(8, output_num, filter_size)
+        layer.load_state_dict(legacy_state)
+
+        input = torch.randn(2, 7, 8)
+        expected = []
+        for i in range(len(filter_size)):
+            conv_res = torch.relu(F.conv1d(torch.transpose(input, 1, 2), legacy_state["convs.%d.weight" % i]))
+            expected.append(conv_res.max(dim=2)[0])
+        self.assertTrue(torch.allclose(layer(input), torch.cat(expected, dim=-1), atol=1e-6))
+
+    def test_load_scripted_state_dict(self):
+        layer = CnnMaxpoolLayer(8, [3, 3], [2, 4])
+        scripted_state = torch.jit.script(layer).state_dict()
+        self.assertIn("weight_mask", scripted_state)
+
+        new_layer = CnnMaxpoolLayer(8, [3, 3], [2, 4])
+        new_layer.load_state_dict(scripted_state)
+
+        input = torch.randn(2, 6, 8)
+        self.assertTrue(torch.equal(new_layer(input), layer(input)))
+        self.assertTrue(torch.equal(new_layer.weight_mask, layer.weight_mask))
+
+    def test_input_shorter_than_filter(self):
+        #比最大的卷积核短的输入等价于右侧补零到最大卷积核的长度
+        for filter_size, padding in [([1, 4], 0), ([4, 4], 0), ([2, 5], 1)]:
+            layer = CnnMaxpoolLayer(8, 3, filter_size, padding=padding, activation="tanh")
+            input = torch.randn(2, 2, 8)
+            padded = torch.cat([input, torch.zeros(2, max(filter_size) - 2 * padding - 2, 8)], dim=1)
+            expected = reference_forward(layer, padded, [3] * len(filter_size), filter_size,
+                                         1, padding, torch.tanh)
+            self.assertTrue(torch.allclose(layer(input), expected, atol=1e-6))
+            self.assertTrue(torch.allclose(torch.jit.script(layer)(input), expected, atol=1e-6))
@@ -4,10 +4,16 @@ import time
 import os
 import sys
 import traceback
+import contextlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 from training.learner_util import MetricTracker, rescale_gradients, TensorBoardWriter
 from training.learner_util import dump_metrics, Checkpointer, enable_gradient_clipping
-from training.learner_util import generate_mask
+from training.learner_util import DistributedIterator, CUDAPrefetcher, move_to_cpu, mark_last
 from training.metric import *
 from training.loss import *
 from training.optimizer import *
@@ -28,7 +34,9 @@ class Trainer(object):
                     histogram_interval=200, should_log_parameter_statistics=False,
                     should_log_learning_rate=False, log_batch_size_period=False,
                     num_serialized_models_to_keep=20, sequence_model=False, fields=None,
-                     model_conf=None, padding_idx=1, use_fp16=False, multi_gpu=False, **kwargs):          
+                     model_conf=None, padding_idx=1, use_fp16=False, multi_gpu=False,
+                     local_rank=None, accum_steps=1, memory_format=None,
+                     jit_script=False, quantize_test=False, cudnn_benchmark=False, **kwargs):          
         """
         训练过程的封装
 
@@ -50,8 +58,23 @@ class Trainer(object):
         :params log_batch_size_period int 将batch_size信息传递给tensorboard的频率
         :params num_serialized_models_to_keep int 模型的前多少epoch保存checkpoint，默认为20
         :params sequence_model bool 模型输入是否需要传入seq_length，和lstm做兼容
+        :params multi_gpu bool 是否采用DistributedDataParallel多卡训练，需要用torchrun启动，否则退回单进程训练
+        :params local_rank int 当前进程使用的gpu，None则从环境变量LOCAL_RANK读取
+        :params accum_steps int 梯度累积的batch数，每accum_steps个batch更新一次参数；
+                epoch末尾不满accum_steps的batch也会更新一次，梯度按实际的batch数取平均
+        :params memory_format str "channels_last"则把模型的4维卷积权重转成NHWC的存储格式，
+                只对Conv2d生效，Conv1d的权重和[batch, length]的token输入不受影响
+        :params jit_script bool 是否用torch.jit.script编译模型，融合pointwise的op，减少python开销，
+                要求模型的forward可以被script(例如TextCnn)
+        :params quantize_test bool 测试集评估时是否把embedding和linear的权重动态量化成int8，只在cpu上生效
+        :params cudnn_benchmark bool 是否打开cudnn.benchmark，只有field设置了fix_length、每个batch长度固定时才有收益，
+                batch长度不固定时每遇到一个新长度都会重新选一次算法，反而变慢
         """
-        
+        #torchtext按每个batch自己的最大长度padding，输入尺寸一般不固定，benchmark默认关闭；允许ampere以上的卡用tf32做矩阵乘和卷积
+        torch.backends.cudnn.benchmark = cudnn_benchmark
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
         self.model = model
         self.num_epochs = num_epochs
         self.train_iter = train_iter
@@ -68,10 +91,50 @@ class Trainer(object):
         self.padding_idx = padding_idx
         self.use_fp16 = use_fp16
         self.multi_gpu = multi_gpu
+        self.accum_steps = accum_steps
+        self.quantize_test = quantize_test
+        #生成sequence mask用的arange，缓存在device上按需扩容
+        self._arange_cache = None
+
+        if not getattr(train_iter, "sort_within_batch", False):
+            logger.warning("train_iter is not a BucketIterator with sort_within_batch=True, "
+                           "batches may contain a lot of padding")
+
+        if self.multi_gpu and ("WORLD_SIZE" not in os.environ or "RANK" not in os.environ):
+            #没有用torchrun启动时退回单进程训练，和原来DataParallel在单卡上的行为一致
+            logger.warning("multi_gpu is set but WORLD_SIZE/RANK are not in the environment, "
+                           "falling back to single-process training; launch with torchrun to use DDP")
+            self.multi_gpu = False
+
+        if self.multi_gpu:
+            #一个进程一张卡，device由local_rank决定
+            if local_rank is None:
+                local_rank = int(os.environ.get("LOCAL_RANK", 0))
+            self.local_rank = local_rank
+            dist.init_process_group(backend="nccl")
+            torch.cuda.set_device(local_rank)
+            self.cuda_device = torch.device("cuda", local_rank)
+            self.train_iter = DistributedIterator(train_iter, dist.get_rank(), dist.get_world_size())
+            self.is_master = dist.get_rank() == 0
+        else:
+            self.is_master = True
 
         if self.cuda_device != -1:
             self.model =self.model.to(self.cuda_device)
 
+        if memory_format == "channels_last":
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        #稀疏梯度的embedding参数单独用SparseAdam优化，需要在script之前从nn.Embedding上取
+        sparse_parameters = [module.weight for module in self.model.modules()
+                             if isinstance(module, torch.nn.Embedding) and module.sparse]
+
+        #script需要在amp和ddp包装之前
+        #ddp包装之后self.model不再是ScriptModule，单独记录是否script过
+        self._scripted = jit_script
+        if jit_script:
+            self.model = torch.jit.script(self.model)
+
         self.grad_norm = grad_norm
         self.grad_clipping = grad_clipping
 
@@ -87,10 +150,14 @@ class Trainer(object):
         self.batch_num_total = 0
 
         self.checkpointer = Checkpointer(serialization_dir, num_serialized_models_to_keep)
+        #checkpoint在后台线程里写盘，和下一个epoch的训练重叠
+        self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_checkpoint = None
         self.metric_tracker = MetricTracker(patience, validation_metric)
+        #多卡训练时只有rank 0打点
         self.tensorboard = TensorBoardWriter(
             get_batch_num_total=lambda: self.batch_num_total,
-            serialization_dir=serialization_dir,
+            serialization_dir=serialization_dir if self.is_master else None,
             summary_interval=summary_interval,
             histogram_interval=histogram_interval,
             should_log_parameter_statistics=should_log_parameter_statistics,
@@ -99,7 +166,11 @@ class Trainer(object):
         if histogram_interval is not None:
             self.tensorboard.enable_activation_logging(self.model)
 
-        self.optimizer = globals()[optimizer](model.parameters())
+        #device配置可能是"cpu"，以参数实际所在的设备为准
+        self._on_cuda = next(self.model.parameters()).is_cuda
+        self.optimizer = build_optimizer(optimizer, self.model.parameters(),
+                                         use_cuda=self._on_cuda,
+                                         sparse_parameters=sparse_parameters)
         if not self.sequence_model:
             self.metric = globals()[metric](self.label_index)
         else:
@@ -108,19 +179,18 @@ class Trainer(object):
         if loss is not None:
             self.loss_func = globals()[loss]()
 
-        if self.use_fp16:
-            try:
-                from apex import amp
-            except ImportError:
-                raise ImportError("Please install apex from https://www.github.com/nvidia/apex")
-
-            self.model, self.optimizer = amp.initialize(self.model, self.optimizer, opt_level="O1")
+        #原生amp混合精度，GradScaler负责loss的缩放，避免fp16下梯度下溢
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_fp16)
 
         if self.multi_gpu:
-            n_gpus = torch.cuda.device_count()
-            if n_gpus > 1:
-                self.param_model = self.model #patch
-                self.model = torch.nn.DataParallel(self.model) #multi-gpu init shoul after fp16, and multi gpu trully is multi-thread
+            self.model = DistributedDataParallel(self.model, device_ids=[self.local_rank],
+                                                 output_device=self.local_rank,
+                                                 find_unused_parameters=False)
+
+        #参数列表在所有包装完成之后缓存一次，训练循环里不再遍历module树；名字取自未包装的模型
+        param_model = self.model.module if hasattr(self.model, "module") else self.model
+        self._named_params = list(param_model.named_parameters())
+        self._histogram_parameters = set(name for name, _ in self._named_params)
 
     def rescale_gradients(self):
         return rescale_gradients(self.model, self.grad_norm)
@@ -159,7 +229,7 @@ class Trainer(object):
                     metrics["peak_" + key] = max(metrics.get("peak_" + key, 0), value)
 
             if self.val_iter is not None:
-                with torch.no_grad():
+                with self.eval_context():
                     val_loss, num_batches = self.val_epoch(self.model)
                     val_metrics = self.get_metrics(val_loss, num_batches, reset=True)
                     this_epoch_val_metric = val_metrics[self.validation_metric]
@@ -190,7 +260,7 @@ class Trainer(object):
 
                 self.metric_tracker.best_epoch_metrics = val_metrics
 
-            if self.serialization_dir:
+            if self.serialization_dir and self.is_master:
                 dump_metrics(os.path.join(self.serialization_dir, f'metrics_epoch_{epoch}.json'), metrics)
 
             if self.learning_rate_scheduler:
@@ -198,22 +268,28 @@ class Trainer(object):
                 # if it doesn't, the validation metric passed here is ignored.
                 self.learning_rate_scheduler.step(this_epoch_val_metric, epoch)
 
-            self.save_checkpoint(epoch)
+            if self.is_master:
+                self.save_checkpoint(epoch)
             train_epoch += 1
 
+        self.wait_for_checkpoint()
+        if self.multi_gpu:
+            #等待rank 0写完best.th
+            dist.barrier()
+
         if self.test_iter is not None:
-            if self.multi_gpu:
-                self.param_model.load_state_dict(torch.load(os.path.join(self.serialization_dir, "best.th")))
-                test_loss, test_batches = self.val_epoch(self.param_model, mode="test")
-            else:
-                self.model.load_state_dict(torch.load(os.path.join(self.serialization_dir, "best.th")))
-                test_loss, test_batches = self.val_epoch(self.model, mode="test")
+            model = self.model.module if hasattr(self.model, "module") else self.model
+            model.load_state_dict(torch.load(os.path.join(self.serialization_dir, "best.th"),
+                                             map_location=self.cuda_device if self.cuda_device != -1 else "cpu"))
+            with self.eval_context():
+                test_loss, test_batches = self.val_epoch(model, mode="test")
             test_metrics = self.get_metrics(test_loss, test_batches, reset=True)
             test_metrics["label_index"] = self.label_index
-            if self.serialization_dir is not None:
+            if self.serialization_dir is not None and self.is_master:
                 dump_metrics(os.path.join(self.serialization_dir, f'test_metrics'), test_metrics)
 
-        self.dump_info()
+        if self.is_master:
+            self.dump_info()
             
         return metrics
 
@@ -245,7 +321,8 @@ class Trainer(object):
         training_states = {
             "metric_traceker": self.metric_tracker.state_dict(),
             "optimizer": self.optimizer.state_dict(),
-            "batch_num_total": self.batch_num_total
+            "batch_num_total": self.batch_num_total,
+            "scaler": self.scaler.state_dict()
         }
         if self.learning_rate_scheduler is not None:
             training_states["learning_rate_scheduler"] = (
@@ -254,13 +331,31 @@ class Trainer(object):
 
         #comfortabel with the multi-gpu training
         model_state = self.model.state_dict() if not hasattr(self.model, "module") else self.model.module.state_dict()
-        self.checkpointer.save_checkpoint(
+
+        #先拷贝一份cpu上的快照，后台线程序列化时训练可以继续更新参数
+        model_state = move_to_cpu(model_state)
+        training_states = move_to_cpu(training_states)
+        #拷贝是在参数所在的卡上异步发起的，只同步当前卡(默认cuda:0)不够
+        if self._on_cuda:
+            torch.cuda.synchronize(self.cuda_device)
+
+        self.wait_for_checkpoint()
+        self._pending_checkpoint = self._checkpoint_executor.submit(
+            self.checkpointer.save_checkpoint,
             model_state=model_state,
             epoch=epoch,
             training_states=training_states,
             is_best_so_far=self.metric_tracker.is_best_so_far()
         )
 
+    def wait_for_checkpoint(self):
+        """
+        等待上一次后台的checkpoint写完，写盘的异常会在这里抛出
+        """
+        if self._pending_checkpoint is not None:
+            self._pending_checkpoint.result()
+            self._pending_checkpoint = None
+
     def restore_checkpoint(self):
         """
         恢复模型的训练，从最近一次保存的模型恢复checkpoint
@@ -270,8 +365,11 @@ class Trainer(object):
             # No checkpoint to restore, start at 0
             return 0
 
-        self.model.load_state_dict(model_state)
+        model = self.model.module if hasattr(self.model, "module") else self.model
+        model.load_state_dict(model_state)
         self.optimizer.load_state_dict(training_state["optimizer"])
+        if "scaler" in training_state:
+            self.scaler.load_state_dict(training_state["scaler"])
         if self.learning_rate_scheduler is not None and "learning_rate_scheduler" in training_state:
             self.learning_rate_scheduler.load_state_dict(training_state["learning_rate_scheduler"])
 
@@ -311,103 +409,132 @@ class Trainer(object):
             self.batch_num_total = 0
         
         if self.multi_gpu:
-            histogram_parameters = set(self.param_model.get_parameter_names())
-        else:
-            histogram_parameters = set(self.model.get_parameter_names())
+            self.train_iter.set_epoch(epoch)
 
         logger.info("Training")
 
-        for batch_group in self.train_iter:
-            batches_this_epoch += 1
-            self.batch_num_total += 1
-            self.optimizer.zero_grad()
+        #gpu训练时用单独的stream预取下一个batch，batch_loss里的.to()就变成了no-op
+        if self._on_cuda:
+            train_iter = CUDAPrefetcher(self.train_iter, self.cuda_device)
+        else:
+            train_iter = self.train_iter
 
-            loss = self.batch_loss(self.model, batch_group)
-            if torch.isnan(loss):
-                raise ValueError("nan loss encountered")
+        for batch_group, is_last in mark_last(train_iter):
+            batches_this_epoch += 1
+            should_step = batches_this_epoch % self.accum_steps == 0 or is_last
+            if (batches_this_epoch - 1) % self.accum_steps == 0:
+                self.optimizer.zero_grad(set_to_none=True)
 
-            if self.use_fp16:
-                from apex import amp
-                with amp.scale_loss(loss, self.optimizer) as scale_loss:
-                    scale_loss.backward()
+            #梯度累积的中间batch不需要做梯度的all-reduce
+            if self.multi_gpu and not should_step:
+                sync_context = self.model.no_sync()
             else:
-                loss.backward()
-            train_loss += loss.item()
+                sync_context = contextlib.nullcontext()
+
+            with sync_context:
+                loss = self.batch_loss(self.model, batch_group)
+
+                self.scaler.scale(loss / self.accum_steps).backward()
+            #loss累加在device上，只在打点和epoch结束时才同步回host
+            train_loss += loss.detach()
+            if not should_step:
+                continue
+
+            self.batch_num_total += 1
+            #先unscale梯度，保证梯度范数的rescale看到的是真实的梯度大小
+            self.scaler.unscale_(self.optimizer)
+            #epoch末尾不满一组时，loss是按accum_steps平均的，修正为按实际的batch数平均
+            group_size = (batches_this_epoch - 1) % self.accum_steps + 1
+            if group_size != self.accum_steps:
+                for _, param in self._named_params:
+                    if param.grad is not None:
+                        param.grad.mul_(self.accum_steps / group_size)
             batch_grad_norm = self.rescale_gradients()
 
             if self.tensorboard.should_log_histograms_this_batch():
                 # get the magnitude of parameter updates for logging
-                # We need a copy of current parameters to compute magnitude of updates,
-                # and copy them to CPU so large models won't go OOM on the GPU.
-                param_updates = {name: param.detach().cpu().clone()
-                                 for name, param in self.model.named_parameters()}
-                self.optimizer.step()
-                for name, param in self.model.named_parameters():
-                    param_updates[name].sub_(param.detach().cpu())
-                    update_norm = torch.norm(param_updates[name].view(-1, ))
-                    param_norm = torch.norm(param.view(-1, )).cpu()
-                    self.tensorboard.add_train_scalar("gradient_update/" + name,
-                                                       update_norm / (param_norm + 1e-7))
+                # 参数的快照留在device上，避免每次打点都把整个模型拷回cpu
+                names, params = zip(*[(name, param.detach())
+                                      for name, param in self._named_params])
+                param_snapshots = [param.clone() for param in params]
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                #foreach的norm一次处理所有参数，最后只做一次device到host的同步
+                update_norms = torch._foreach_norm(torch._foreach_sub(param_snapshots, params))
+                param_norms = torch._foreach_norm(params)
+                update_ratios = (torch.stack(update_norms) / (torch.stack(param_norms) + 1e-7)).tolist()
+                self.tensorboard.add_train_scalars("gradient_update/", dict(zip(names, update_ratios)))
             else:
-                self.optimizer.step()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
             if self.tensorboard.should_log_this_batch():
-                self.tensorboard.log_parameter_and_gradient_statistics(self.model, batch_grad_norm)
-                self.tensorboard.log_learning_rates(self.model, self.optimizer)
+                self.check_nan_loss(train_loss)
+                self.tensorboard.log_parameter_and_gradient_statistics(self._named_params, batch_grad_norm)
+                self.tensorboard.log_learning_rates(self._named_params, self.optimizer)
 
                 metrics = self.get_metrics(train_loss, batches_this_epoch)
                 self.tensorboard.add_train_scalar("loss/loss_train", metrics["loss"])
                 self.tensorboard.log_metrics({"epoch_metrics/" + k: v for k, v in metrics.items()})
 
             if self.tensorboard.should_log_histograms_this_batch():
-                self.tensorboard.log_histograms(self.model, histogram_parameters)
+                self.tensorboard.log_histograms(self._named_params, self._histogram_parameters)
 
+        self.check_nan_loss(train_loss)
         metrics = self.get_metrics(train_loss, batches_this_epoch, reset=True)
         return metrics
+
+    def check_nan_loss(self, train_loss):
+        """
+        nan会在累加的loss里传播，只在需要把loss同步回host的时候检查，避免每个batch同步
+        """
+        if math.isnan(float(train_loss)):
+            raise ValueError("nan loss encountered")
         
     def get_metrics(self, loss, batchs, reset=False):
         metrics = self.metric.get_metric(reset)
-        metrics["loss"] = float(loss) / (batchs + 1e-8) if float(loss) > 0 else 0.0
+        #loss可能是device上的tensor，这里只做一次同步
+        loss = float(loss)
+        metrics["loss"] = loss / (batchs + 1e-8) if loss > 0 else 0.0
         return metrics
 
     def batch_loss(self, model, batch_group):
         """
-        每个batch的数据得到loss
+        每个batch的数据得到loss，field都是batch_first的，数据为[batch, length]
         """
         tmp = batch_group.TEXT
         label = batch_group.LABEL
-        if len(label.size()) > 1:
-            label = label.t()
-
-        if len(tmp) == 2:
-            data = tmp[0].t()
-            data_seq_length = tmp[1]
 
-            seq_len = data.size(1)
-            batch_size = data.size(0)
-            mask = generate_mask(data_seq_length, seq_len, batch_size)
+        if isinstance(tmp, tuple):
+            data, data_seq_length = tmp
         else:
-            data = tmp.t()
+            data = tmp
             data_seq_length = None
-            mask = (data != self.padding_idx).long() #mask计算todo
 
         if self.cuda_device != -1:
-            data, label = data.to(self.cuda_device), label.to(self.cuda_device)
-            mask = mask.to(self.cuda_device)
+            data = data.to(self.cuda_device, non_blocking=True)
+            label = label.to(self.cuda_device, non_blocking=True)
 
+        #mask在数据拷贝到device之后再算，保持bool类型，不再单独拷贝mask
         if data_seq_length is not None:
-            res = model(data, data_seq_length, mask, label)
+            mask = self.sequence_mask(data_seq_length, data.size(1), data.device)
         else:
-            res = model(data, mask, label)
-
-        #计算loss
-        logits = res["logits"]
-        if "loss" not in res:
-            loss = self.loss_func(logits, label)
-            if "coefficient" in res:
-                loss += res["coefficient"] * res["regulariration_loss"]
-        else:
-            loss = res["loss"]
+            mask = data != self.padding_idx
+
+        with torch.cuda.amp.autocast(enabled=self.use_fp16):
+            if data_seq_length is not None:
+                res = model(data, data_seq_length, mask, label)
+            else:
+                res = model(data, mask, label)
+
+            #计算loss
+            logits = res["logits"]
+            if "loss" not in res:
+                loss = self.loss_func(logits, label)
+                if "coefficient" in res:
+                    loss += res["coefficient"] * res["regulariration_loss"]
+            else:
+                loss = res["loss"]
         #更新metric
         if self.sequence_model:
             self.metric(logits, label, mask)
@@ -415,6 +542,43 @@ class Trainer(object):
             self.metric(logits, label)
         return loss
 
+    def sequence_mask(self, data_seq_length, seq_len, device):
+        """
+        根据batch中每个sequence的实际长度生成[batch, seq_len]的bool mask
+        """
+        if self._arange_cache is None or self._arange_cache.size(0) < seq_len \
+                or self._arange_cache.device != device:
+            self._arange_cache = torch.arange(seq_len, device=device)
+
+        lengths = data_seq_length.to(device, non_blocking=True)
+        return self._arange_cache[:seq_len].unsqueeze(0) < lengths.unsqueeze(1)
+
+    def eval_context(self):
+        """
+        评估用的上下文，inference_mode比no_grad更省，不做version counter和view的追踪；
+        script之后的模型在inference_mode下会报错，退回no_grad
+        """
+        if self._scripted:
+            return torch.no_grad()
+        return torch.inference_mode()
+
+    def quantize_model(self, model):
+        """
+        返回embedding和linear权重动态量化成int8的模型副本，训练用的fp32权重不受影响
+        """
+        if self._on_cuda:
+            logger.warning("int8 quantization only runs on cpu, evaluating the fp32 model")
+            return model
+        if isinstance(model, torch.jit.ScriptModule):
+            logger.warning("scripted model can not be quantized, evaluating the fp32 model")
+            return model
+
+        qconfig_spec = {
+            torch.nn.Linear: torch.quantization.default_dynamic_qconfig,
+            torch.nn.Embedding: torch.quantization.float_qparams_weight_only_qconfig
+        }
+        return torch.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+
     def val_epoch(self, model, mode="val"):
         if mode == "val":
             logger.info("Validating")
@@ -422,7 +586,10 @@ class Trainer(object):
         else:
             logging.info("Test")
             data_iter = self.test_iter
+            if self.quantize_test:
+                model = self.quantize_model(model)
 
+        #batch_loss内部已经按use_fp16开启了autocast
         model.eval()
         batches_this_epoch = 0
         val_loss = 0.0
@@ -432,7 +599,7 @@ class Trainer(object):
 
             if loss is not None:
                 batches_this_epoch += 1
-                val_loss += loss.detach().cpu().numpy()
+                val_loss += loss.detach()
 
         return val_loss, batches_this_epoch
     
@@ -4,9 +4,12 @@ import shutil
 import re
 import logging
 import json
+import random
 
 import torch
 from tensorboardX import SummaryWriter
+from tensorboardX.summary import scalar
+from tensorboardX.proto.summary_pb2 import Summary
 
 logger = logging.getLogger(__name__)
 
@@ -111,6 +114,120 @@ class Checkpointer(object):
             return {}
 
 
+def mark_last(iterable):
+    """
+    迭代时提前取一个元素，返回(item, is_last)，不依赖len()
+    """
+    iterator = iter(iterable)
+    current = next(iterator, None)
+    while current is not None:
+        upcoming = next(iterator, None)
+        yield current, upcoming is None
+        current = upcoming
+
+
+def _iterator_len(data_iter):
+    """
+    torchtext的iterator设置了batch_size_fn(max_tokens)时len()会抛NotImplementedError，
+    转成TypeError，list()等按照协议当作没有长度处理
+    """
+    try:
+        return len(data_iter)
+    except NotImplementedError:
+        raise TypeError("iterator with batch_size_fn has no len()")
+
+
+class DistributedIterator(object):
+    def __init__(self, data_iter, rank, world_size, seed=1441):
+        """
+        多卡(DDP)训练时对torchtext iterator的切分，作用等价于DistributedSampler，
+        每个进程只取属于自己rank的batch
+
+        :params data_iter torchtext.data.Iterator 原始的数据迭代器
+        :params rank int 当前进程的rank
+        :params world_size int 总的进程数
+        :params seed int shuffle的随机种子，所有进程必须一致才能保证batch的切分不重叠
+        """
+        self.data_iter = data_iter
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """
+        每个epoch开始前调用，保证所有进程在同一个epoch内的shuffle顺序一致
+        """
+        shuffler = getattr(self.data_iter, "random_shuffler", None)
+        if shuffler is not None:
+            shuffler.random_state = random.Random(self.seed + epoch).getstate()
+
+    def __len__(self):
+        return _iterator_len(self.data_iter) // self.world_size
+
+    def __iter__(self):
+        #每world_size个batch为一组，每个进程取组内自己rank的batch；
+        #末尾不满一组的batch丢掉，保证各个进程的batch数相同，避免all-reduce卡住。
+        #不依赖len()，max_tokens(batch_size_fn)的iterator没有长度
+        group = []
+        for batch in self.data_iter:
+            group.append(batch)
+            if len(group) == self.world_size:
+                yield group[self.rank]
+                group = []
+
+
+class CUDAPrefetcher(object):
+    def __init__(self, data_iter, device):
+        """
+        在单独的cuda stream上提前把下一个batch拷贝到gpu，和当前batch的计算重叠
+
+        :params data_iter 产出torchtext Batch的迭代器
+        :params device 目标gpu
+        """
+        self.data_iter = data_iter
+        self.device = device
+
+    def __len__(self):
+        return _iterator_len(self.data_iter)
+
+    def _to_device(self, tensor):
+        #torchtext产出的是pageable内存，先pin住才能真正异步拷贝
+        return tensor.pin_memory().to(self.device, non_blocking=True)
+
+    def _preload(self, iterator, stream):
+        batch = next(iterator, None)
+        if batch is None:
+            return None
+
+        with torch.cuda.stream(stream):
+            for name in batch.fields:
+                value = getattr(batch, name)
+                if isinstance(value, tuple):
+                    #include_lengths时长度留在cpu上，生成mask和pack都需要在cpu
+                    value = (self._to_device(value[0]),) + tuple(value[1:])
+                elif isinstance(value, torch.Tensor):
+                    value = self._to_device(value)
+                setattr(batch, name, value)
+        return batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.data_iter)
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = next_batch
+            #告诉显存分配器这些tensor在主stream上被使用，避免被提前复用
+            for name in batch.fields:
+                value = getattr(batch, name)
+                value = value[0] if isinstance(value, tuple) else value
+                if isinstance(value, torch.Tensor) and value.is_cuda:
+                    value.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._preload(iterator, stream)
+            yield batch
+
+
 class MetricTracker(object):
     def __init__(self,
                  patience,
@@ -272,6 +389,18 @@ class TensorBoardWriter(object):
         if self._train_log is not None:
             self._train_log.add_scalar(name, self._item(value), self._get_batch_num_total())
     
+    def add_train_scalars(self, tag_prefix, values):
+        """
+        一次写入多个scalar，所有的值放在同一个summary event里，tag和add_train_scalar一致
+
+        :params tag_prefix str tag的前缀
+        :params values dict[str, float] 名字到值的映射
+        """
+        if self._train_log is not None and values:
+            summary = Summary(value=[scalar(tag_prefix + name, value).value[0]
+                                     for name, value in values.items()])
+            self._train_log._get_file_writer().add_summary(summary, self._get_batch_num_total())
+
     def add_train_histogram(self, name, values):
         if self._train_log is not None:
             if isinstance(values, torch.Tensor):
@@ -283,14 +412,16 @@ class TensorBoardWriter(object):
             self._validation_log.add_scalar(name, self._item(value), self._get_batch_num_total())
 
     def log_parameter_and_gradient_statistics(self,
-                                              model,
+                                              named_parameters,
                                               batch_grad_norm=None):
         """
         把模型的参数和梯度的统计量（均值和方差）打点到tensorboard
+
+        :params named_parameters list[(str, Parameter)] 模型的参数，由调用方缓存
         """
         if self._should_log_parameter_statistics:
             # Log parameter values to Tensorboard
-            for name, param in model.named_parameters():
+            for name, param in named_parameters:
                 self.add_train_scalar("parameter_mean/" + name, param.data.mean())
                 self.add_train_scalar("parameter_std/" + name, param.data.std())
                 if param.grad is not None:
@@ -311,7 +442,7 @@ class TensorBoardWriter(object):
                 self.add_train_scalar("gradient_norm", batch_grad_norm)
 
     def log_learning_rates(self,
-                           model,
+                           named_parameters,
                            optimizer):
         """
         把当前模型的学习率打点到tensorboard
@@ -319,7 +450,7 @@ class TensorBoardWriter(object):
         if self._should_log_learning_rate:
             # optimizer stores lr info keyed by parameter tensor
             # we want to log with parameter name
-            names = {param: name for name, param in model.named_parameters()}
+            names = {param: name for name, param in named_parameters}
             for group in optimizer.param_groups:
                 if 'lr' not in group:
                     continue
@@ -329,13 +460,14 @@ class TensorBoardWriter(object):
                     effective_rate = rate * float(param.requires_grad)
                     self.add_train_scalar("learning_rate/" + names[param], effective_rate)
 
-    def log_histograms(self, model, histogram_parameters):
+    def log_histograms(self, named_parameters, histogram_parameters):
         """
         模型柱状图的参数打点到tensorboardx
 
+        :params named_parameters list[(str, Parameter)] 模型的参数，由调用方缓存
         :params histogram_parameters set|list[str] 打点的名字
         """
-        for name, param in model.named_parameters():
+        for name, param in named_parameters:
             if name in histogram_parameters:
                 self.add_train_histogram("parameter_histogram/" + name, param)
 
@@ -433,6 +565,9 @@ def rescale_gradients(model, grad_norm):
     if grad_norm:
         parameters_to_clip = [p for p in model.parameters()
                               if p.grad is not None]
+        #稠密梯度走torch的foreach实现，一次kernel算完所有参数的范数
+        if not any(p.grad.is_sparse for p in parameters_to_clip):
+            return torch.nn.utils.clip_grad_norm_(parameters_to_clip, grad_norm, foreach=True)
         return sparse_clip_norm(parameters_to_clip, grad_norm)
     return None
 
@@ -508,6 +643,23 @@ def clamp_tensor(tensor, minimum, maximum):
     else:
         return tensor.clamp(minimum, maximum)
 
+def move_to_cpu(obj):
+    """
+    把state_dict里的tensor异步拷贝到cpu，dict/list/tuple会递归地生成新的容器
+    cpu上的tensor需要clone，否则快照和训练中的参数共享storage
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == "cpu":
+            return obj.detach().clone()
+        return obj.detach().to("cpu", non_blocking=True)
+    elif isinstance(obj, dict):
+        return {key: move_to_cpu(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(move_to_cpu(value) for value in obj)
+    else:
+        return obj
+
+
 def dump_metrics(file_path, metrics, log=False):
     metrics_json = json.dumps(metrics, indent=2, ensure_ascii=False)
     with open(file_path, "w") as metrics_file:
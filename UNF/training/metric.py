@@ -59,9 +59,14 @@ class F1Measure(Metric):
                  predictions,
                  gold_labels,
                  mask=None):
-        predictions, gold_labels, mask = self.unwrap_to_tensors(predictions, gold_labels, mask)
+        #统计量直接在tensor所在的device上累加，只在get_metric时同步回host
+        predictions, gold_labels = predictions.detach(), gold_labels.detach()
+        mask = mask.detach() if mask is not None else None
         num_classes = predictions.size(-1)
-        if (gold_labels >= num_classes).any():
+        if gold_labels.is_cuda:
+            #gpu上异步断言，不在每个batch同步
+            torch._assert_async((gold_labels < num_classes).all())
+        elif (gold_labels >= num_classes).any():
             raise Exception("A gold label passed to F1Measure contains an id >= {}, "
                                      "the number of classes.".format(num_classes))
         if mask is None:
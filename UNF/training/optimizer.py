@@ -1 +1,67 @@
-from torch.optim import Adam, SGD, SparseAdam, Adagrad, Adadelta, RMSprop
\ No newline at end of file
+#coding:utf-8
+from torch.optim import Adam, AdamW, SGD, SparseAdam, Adagrad, Adadelta, RMSprop
+
+
+#优化器名字 -> (优化器类, gpu上使用的多参数合并实现)
+OPTIMIZERS = {
+    "Adam": (Adam, "fused"),
+    "AdamW": (AdamW, "fused"),
+    "SGD": (SGD, "foreach"),
+    "SparseAdam": (SparseAdam, None),
+    "Adagrad": (Adagrad, "foreach"),
+    "Adadelta": (Adadelta, "foreach"),
+    "RMSprop": (RMSprop, "foreach"),
+}
+
+
+class MultiOptimizer(object):
+    def __init__(self, *optimizers):
+        """
+        多个优化器的组合，对外表现为一个优化器，例如稀疏梯度的embedding用SparseAdam，其余参数用稠密的优化器
+        """
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self, closure=None):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return {"optimizers": [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict["optimizers"]):
+            optimizer.load_state_dict(state)
+
+
+def build_optimizer(name, parameters, use_cuda=False, sparse_parameters=None, **kwargs):
+    """
+    根据名字构造优化器，gpu上默认打开fused/foreach实现，把逐参数的更新合并成少量kernel
+
+    :params name str 优化器的名字，OPTIMIZERS中的key
+    :params parameters 需要优化的参数
+    :params use_cuda bool 参数是否在gpu上
+    :params sparse_parameters list 产生稀疏梯度的参数，单独用SparseAdam优化
+    """
+    if name not in OPTIMIZERS:
+        raise Exception("%s optimizer not support" % name)
+
+    optimizer_cls, impl = OPTIMIZERS[name]
+    if use_cuda and impl is not None:
+        kwargs.setdefault(impl, True)
+
+    if not sparse_parameters:
+        return optimizer_cls(parameters, **kwargs)
+
+    sparse_ids = set(id(param) for param in sparse_parameters)
+    dense_parameters = [param for param in parameters if id(param) not in sparse_ids]
+    sparse_kwargs = {"lr": kwargs["lr"]} if "lr" in kwargs else {}
+    return MultiOptimizer(optimizer_cls(dense_parameters, **kwargs),
+                          SparseAdam(sparse_parameters, **sparse_kwargs))